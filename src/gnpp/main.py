@@ -35,7 +35,9 @@ def parse_args(argstring=None):
     parser.add_argument('--gpu', type=int, default=1, help='-1: cpu, others: gpu index')
     parser.add_argument('--eval', type=str, default='', help='a time_str. evaluate model using checpoint_dir/dataset/time_str/state_dict_filename.state_dict')
     parser.add_argument('--state_dict', type=str, help='state_dict filename (without suffix)')
-    parser.add_argument('--parallel_eval', default=None, action='store_true', help='parallel evaluate mode')
+    parser.add_argument('--num_workers', type=int, default=2, help='number of test dataloader worker processes')
+    parser.add_argument('--compile', default=False, action='store_true', help='compile the model forward with torch.compile (PyTorch >= 2.0)')
+    parser.add_argument('--amp', default=False, action='store_true', help='run the model forward under bfloat16 autocast')
 
     # dataset 
     parser.add_argument('--seed', type=int, default=0, help='seed to initialize all the random modules')
@@ -2,6 +2,7 @@ import numpy as np
 import math
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch import Tensor
 from torch_geometric.nn.inits import glorot
 
@@ -22,17 +23,12 @@ class HarmonicEncoder(TimeEncoder):
         assert dimension % 2 == 0, 'dimension should be an even'
         self.dimension = dimension
         self.basis_freq = torch.nn.Parameter((torch.from_numpy(1 / 5 ** np.linspace(1, 9, dimension//2))).float()) # omega_1, ..., omega_d
-        self.phase_cos = torch.zeros(dimension//2, dtype=torch.float, requires_grad=False) # no gradient
-        self.phase_sin = torch.zeros(dimension//2, dtype=torch.float, requires_grad=False)
+        self.register_buffer('phase_cos', torch.zeros(dimension//2, dtype=torch.float), persistent=False) # no gradient, moved by model.to(device)
+        self.register_buffer('phase_sin', torch.zeros(dimension//2, dtype=torch.float), persistent=False)
     
     def forward(self, ts):
         """ harmonic encoding mapping """
         # ts shape: maybe [N]
-        device = ts.device
-        self.basis_freq = self.basis_freq.to(device)
-        self.phase_cos = self.phase_cos.to(device)
-        self.phase_sin = self.phase_sin.to(device)
-
         batch_size = ts.size(0)
         ts = ts.view(batch_size, 1)# [N, 1]
         map_ts = ts * self.basis_freq.view(1, -1) # [N, dimension]
@@ -52,11 +48,9 @@ class PositionEncoder(TimeEncoder):
         self.rows = rows
         self.deltat = maxt / rows
         self.dimension = dimension
-        self.time_embedding = torch.tensor(self.get_timing_encoding_matrix(rows, dimension), dtype=torch.float32)
+        self.register_buffer('time_embedding', torch.tensor(self.get_timing_encoding_matrix(rows, dimension), dtype=torch.float32), persistent=False) # moved by model.to(device)
 
     def forward(self, timestamps: Tensor):
-        if self.time_embedding.device != timestamps.device:
-            self.time_embedding = self.time_embedding.to(timestamps.device)
         indexes = self.timestamps_to_indexes(timestamps)
         indexes = indexes.reshape((-1))
         return self.time_embedding[indexes]
@@ -101,12 +95,16 @@ class GNPP(nn.Module):
             self.time_encoder = HarmonicEncoder(time_encoder_args['dimension'])
         
     
-        self.Atten_self = nn.MultiheadAttention(embed_dim=time_encoder_args['dimension'], num_heads=num_heads, dropout=dropout)
-        self.Atten_neig = nn.MultiheadAttention(embed_dim=time_encoder_args['dimension'], num_heads=num_heads, dropout=dropout)
+        self.Atten_self = nn.MultiheadAttention(embed_dim=time_encoder_args['dimension'], num_heads=num_heads, dropout=dropout, batch_first=True)
+        self.Atten_neig = nn.MultiheadAttention(embed_dim=time_encoder_args['dimension'], num_heads=num_heads, dropout=dropout, batch_first=True)
         self.Linear_lambda = nn.Linear(time_encoder_args['dimension']*2, 1, bias=False)
         self.Linear_pred = nn.Linear(time_encoder_args['dimension']*2, 1)
         self.W_H = torch.nn.Parameter(torch.zeros(time_encoder_args['dimension'], 1))
         self.phi = 0.1
+        # Gauss-Legendre nodes/weights on [-1, 1], for the integral of lambda over each quadrature panel
+        gl_nodes, gl_weights = np.polynomial.legendre.leggauss(4)
+        self.register_buffer('gl_nodes', torch.tensor(gl_nodes, dtype=torch.float32), persistent=False)
+        self.register_buffer('gl_weights', torch.tensor(gl_weights, dtype=torch.float32), persistent=False)
         self.initialize()
     
     def initialize(self,):
@@ -122,24 +120,25 @@ class GNPP(nn.Module):
         e_nodes_exp = torch.cat([torch.tensor([-1], dtype=e_nodes_exp.dtype, device=e_nodes_exp.device), e_node_target, e_nodes_exp], axis=0 )
 
         
-        # build self_mask and neighbor_mask
-        ts_mat = e_nodes_ts.reshape((1, -1)).repeat((t.numel(), 1))
-        key_padding_mask = ts_mat > t.reshape((-1, 1)) # True will be ignored
+        # build self_mask and neighbor_mask, one row per query t
+        attn_mask = e_nodes_ts.reshape((1, -1)) > t.reshape((-1, 1)) # True will be ignored, [t.numel(), e_nodes_ts.numel()]
 
-        self_mask = (e_nodes_exp != e_node_target).reshape(1, -1).repeat((t.numel(), 1))
-        neig_mask = (e_nodes_exp == e_node_target).reshape(1, -1).repeat((t.numel(), 1))
-        key_padding_mask_self = key_padding_mask + self_mask
-        key_padding_mask_neig = key_padding_mask + neig_mask
+        self_mask = (e_nodes_exp != e_node_target).reshape(1, -1) # broadcast over the rows of attn_mask
+        attn_mask_self = attn_mask | self_mask
+        attn_mask_neig = attn_mask | ~self_mask
 
         assert isinstance(self.Atten_self, nn.MultiheadAttention)
 
-        phi_t = self.time_encoder(t).reshape((1, t.numel(), -1)) # query [L, N, E], i.e., [1, t.numel(), encoding_dim)
-        phi_ts_mat = self.time_encoder(e_nodes_ts).reshape((e_nodes_ts.numel(), 1, -1)).repeat((1, t.numel(), 1)) # key/value [S, N, E], i.e., [e_nodes_ts.numel(), t.numel(), encoding_dim]
+        # all t as one query sequence against a single key sequence, so MHA runs batched GEMMs instead of t.numel() seq_len=1 items
+        # one time_encoder call for both inputs instead of two, split afterwards (nothing is deduplicated)
+        phi = self.time_encoder(torch.cat([t.reshape(-1), e_nodes_ts]))
+        phi_t = phi[:t.numel()].reshape((1, t.numel(), -1)) # query [N, L, E], i.e., [1, t.numel(), encoding_dim]
+        phi_ts = phi[t.numel():].reshape((1, e_nodes_ts.numel(), -1)) # key/value [N, S, E], i.e., [1, e_nodes_ts.numel(), encoding_dim]
         # self information
-        self_atten_output, self_weights = self.Atten_self(phi_t, phi_ts_mat, phi_ts_mat, key_padding_mask=key_padding_mask_self)
+        self_atten_output = multihead_sdpa(self.Atten_self, phi_t, phi_ts, attn_mask_self)
         # neighbor information
         if self.kwargs['with_neig']:
-            neig_atten_output, neig_weights = self.Atten_neig(phi_t, phi_ts_mat, phi_ts_mat, key_padding_mask=key_padding_mask_neig)
+            neig_atten_output = multihead_sdpa(self.Atten_neig, phi_t, phi_ts, attn_mask_neig)
         else:
             neig_atten_output = torch.zeros_like(self_atten_output)
         
@@ -151,11 +150,28 @@ class GNPP(nn.Module):
         return lambdav, atten_output        
 
 
+def multihead_sdpa(atten, query, key_value, attn_mask):
+    """ `atten` (batch_first nn.MultiheadAttention) computed with F.scaled_dot_product_attention,
+    so the fused flash/mem-efficient kernels can be picked. Uses the weights of `atten`, state_dict is unchanged.
+    query: [N, L, E], key_value: [N, S, E], attn_mask: [L, S], True will be ignored
+    """
+    batch_size, L, E = query.shape
+    S = key_value.shape[1]
+    num_heads = atten.num_heads
+    w_q, w_kv = atten.in_proj_weight.split([E, 2*E])
+    b_q, b_kv = atten.in_proj_bias.split([E, 2*E]) if atten.in_proj_bias is not None else (None, None)
+
+    q = F.linear(query, w_q, b_q).view(batch_size, L, num_heads, E//num_heads).transpose(1, 2) # [N, H, L, E/H]
+    k, v = F.linear(key_value, w_kv, b_kv).view(batch_size, S, 2, num_heads, E//num_heads).permute(2, 0, 3, 1, 4) # [N, H, S, E/H] each
+    dropout_p = atten.dropout if atten.training else 0.0
+    output = F.scaled_dot_product_attention(q, k, v, attn_mask=~attn_mask, dropout_p=dropout_p) # sdpa: True takes part in attention
+    output = output.transpose(1, 2).reshape(batch_size, L, E)
+    return atten.out_proj(output)
+
+
 def soft_plus(phi, x):
-    x = x * phi
-    x[x>20] = 20
-    res = 1.0/phi * torch.log( 1 + torch.exp(x) )
-    return res
+    # 1/phi * log(1 + exp(phi * x)), linear above the threshold instead of overflowing
+    return F.softplus(x, beta=phi, threshold=20)
 
 
 def get_model(G, embedding_matrix, args, logger):
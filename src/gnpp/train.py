@@ -1,11 +1,9 @@
 import torch
 import numpy as np
-import pandas as pd
 from pathlib import Path
 from tqdm import tqdm
 from torch_geometric.data import Data
-from gnpp.utils_ext.training import get_device, get_model_device, get_optimizer, Recorder
-from gnpp.utils_ext.multiprocessing import MultiProcessor
+from gnpp.utils_ext.training import get_device, get_optimizer, prefetch_to_device, Recorder
 
 
 def soft_plus(phi, x):
@@ -15,22 +13,21 @@ def soft_plus(phi, x):
 def relu_plus(phi, x):
     return phi + torch.nn.functional.relu(x)
 
-def compute_integral(model, batch, t_start, t_end, N=200):
-    assert t_end >= t_start
-    device = t_start.device
-    points = torch.rand(N+2, device=device)[1:-1]*(t_end-t_start)+t_start
-    points = points.to(device)
-
-    values, atten_output = model(batch, points)
-    values = values.reshape((-1, 1))
-
-    intervals = (t_end - t_start)/N
-    intervals = intervals.reshape(-1, 1).repeat(1, N).reshape(-1, 1)
-    assert intervals.shape == values.shape, "intervals.shape should == values.shape"
-
-    values = values * intervals
-    return_values = values.sum()
-    return return_values
+def integral_points(model, T, max_points=100):
+    """ Gauss-Legendre nodes and weights on panels covering (T[0], T[-1]), sum(weights * lambdas) is the integral of lambda.
+    The panels are the inter-event segments while their nodes fit in `max_points`, otherwise equal-width panels,
+    so at most `max_points` extra queries are added to the forward pass (the same budget as the former Monte Carlo integral).
+    """
+    max_panels = max(max_points // model.gl_nodes.numel(), 1)
+    if T.numel() - 1 <= max_panels:
+        edges = T
+    else:
+        edges = torch.linspace(0, 1, max_panels + 1, device=T.device, dtype=T.dtype) * (T[-1] - T[0]) + T[0]
+    starts, ends = edges[:-1].reshape(-1, 1), edges[1:].reshape(-1, 1)
+    half_intervals = 0.5*(ends-starts)
+    points = half_intervals * model.gl_nodes.reshape(1, -1) + 0.5*(ends+starts) # [num_panels, num_nodes]
+    weights = half_intervals * model.gl_weights.reshape(1, -1) # [num_panels, num_nodes]
+    return points.reshape(-1), weights.reshape(-1)
 
 
 def constant_1(model, hid_u, hid_v, emb_u, emb_v):
@@ -39,18 +36,30 @@ def constant_1(model, hid_u, hid_v, emb_u, emb_v):
 def model_device(model):
     return next(model.parameters()).device
 
+def mean_metric(values):
+    """ mean of a list of 0-dim metric tensors, with a single device->host sync """
+    if len(values) == 0:
+        return np.nan
+    return torch.stack(values).float().mean().item()
+
 
 def criterion(model, batch, **kwargs):
     # import ipdb; ipdb.set_trace()
     T_all = batch.T
 
+    n_events = T_all.numel() - 1
+
     intervals = T_all[2:] - T_all[1:-1]
-    lambdav, atten_output = model(batch, T_all[1:])
+    # lambdas at the events and at the integral points, in one forward pass
+    points, weights = integral_points(model, T_all)
+    lambdav, atten_output = model(batch, torch.cat([T_all[1:], points]))
+    lambdav = lambdav.float().reshape(-1) # float32 even under autocast
+    atten_output = atten_output[:n_events]
     pred = model.Linear_pred(atten_output)
 
     # neg likelihood
-    ll0 = torch.log( 1e-9 + lambdav ).sum()
-    integral = compute_integral(model, batch, T_all[0], T_all[-1], N=100)
+    ll0 = torch.log( 1e-9 + lambdav[:n_events] ).sum()
+    integral = (weights * lambdav[n_events:]).sum()
     nll = -1 * (ll0 - integral)
 
     # time mse
@@ -77,6 +86,7 @@ def optimize_epoch(model, optimizer, train_loader, args, logger, **kwargs):
     device = get_device(args.gpu)
     model = model.to(device)
     batch_counter = 0
+    loss_accum = 0.0
     recorder = {'loss': [], 'll':[], 'rmse': []}
 
     if args.model in ['GAT', 'GraphSAGE']:
@@ -90,39 +100,59 @@ def optimize_epoch(model, optimizer, train_loader, args, logger, **kwargs):
         elif isinstance(batch, Data):
             batch = batch.to(device)
 
+        oom = False
         try:
-            loss, ll, time_mse = criter(model, batch)
-            loss.backward()
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=args.amp):
+                loss, ll, time_mse = criter(model, batch)
+            loss_accum = loss_accum + loss
 
             batch_counter += 1
-            if batch_counter % 8 == 0: # update model parameters for one step
+            if batch_counter % 8 == 0: # one backward over the accumulated losses, then update model parameters for one step
+                loss_accum.backward()
                 optimizer.step()
                 optimizer.zero_grad()
                 batch_counter = 0
+                loss_accum = 0.0
           
-            recorder['loss'].append(loss.cpu().item())
-            recorder['ll'].append(ll.cpu().item())
-            recorder['rmse'].append(time_mse.sqrt().cpu().item())
-        except Exception as e:
-            if 'CUDA out of memory' in e.args[0]:
-                continue
-            else: raise
+            # keep metrics on device, they are synced once at the end of the epoch
+            recorder['loss'].append(loss.detach())
+            recorder['ll'].append(ll.detach())
+            recorder['rmse'].append(time_mse.detach().sqrt())
+        except torch.cuda.OutOfMemoryError:
+            oom = True
+        if oom:
+            # clean up outside the except block, the traceback there still references the failed forward's tensors.
+            # drop the current accumulation window, its retained graphs hold most of the memory
+            loss_accum = 0.0
+            loss = ll = time_mse = None
+            batch_counter = 0
+            optimizer.zero_grad()
+            torch.cuda.empty_cache()
+            continue
         
         if args.debug and i == 0:
             break
-    recorder['loss'] = np.mean(recorder['loss'])
-    recorder['ll'] = np.mean(recorder['ll'])
-    recorder['rmse'] = np.mean(recorder['rmse'])
+    if batch_counter > 0:
+        # backward the unfinished window, its gradients carry over into the first step of the next epoch
+        oom = False
+        try:
+            loss_accum.backward()
+        except torch.cuda.OutOfMemoryError:
+            oom = True
+        if oom:
+            # same as in the loop: drop the window and clean up outside the except block
+            loss_accum = 0.0
+            loss = ll = time_mse = None
+            optimizer.zero_grad()
+            torch.cuda.empty_cache()
+    recorder['loss'] = mean_metric(recorder['loss'])
+    recorder['ll'] = mean_metric(recorder['ll'])
+    recorder['rmse'] = mean_metric(recorder['rmse'])
     return recorder
 
 
 def evaluate_batch(model, batch, **kwargs):
-    device = get_model_device(model)
-    if isinstance(batch, list):
-        batch = list(map(lambda x: x.to(device), batch)) # set device
-    elif isinstance(batch, Data):
-        batch = batch.to(device)
-
+    """ batch is expected on the model device already, see prefetch_to_device in evaluate_epoch """
     if kwargs['args'].model in ['GAT', 'GraphSAGE']:
         criter = criterion_gnn # for gnn model run
     else:
@@ -130,11 +160,8 @@ def evaluate_batch(model, batch, **kwargs):
         
     # evaluate metrics
     loss, ll, time_error = criter(model, batch) # mse
-    loss = loss.cpu().item()
-    ll = ll.cpu().item()
-
-    rmse = time_error.sqrt().cpu().item() # rmse
-    return {'loss': loss, 'rmse': rmse, 'll': ll}
+    rmse = time_error.sqrt() # rmse
+    return {'loss': loss, 'rmse': rmse, 'll': ll} # 0-dim tensors, synced in evaluate_epoch
 
 
 
@@ -145,32 +172,33 @@ def evaluate_epoch(model, test_loader, args, logger, **kwargs):
     model = model.to(device)
 
     batch_results = {'loss': [], 'rmse': [], 'll': [], 'abs_ratio': []}
-    if kwargs.get('parallel', None) is not None:
-        mp = MultiProcessor(40)
-        result = mp.run_queue(evaluate_batch, test_loader, model=model, **kwargs)
-        result = pd.DataFrame(result)
-    else:
-        for i, batch_test in tqdm(enumerate(test_loader), total=len(test_loader), desc='- [testing]', leave=False):
-            try:
-                with torch.no_grad():
-                    batch_result = evaluate_batch(model, batch_test, debug=args.debug, args=args)
-                for key in batch_result.keys():
-                    batch_results[key].append(batch_result[key])
-            except Exception as e:
-                if 'CUDA out of memory' in e.args[0]:
-                    continue
-                else: raise
-            
-            if args.debug and i == 100:
-                break
+    for i, batch_test in tqdm(enumerate(prefetch_to_device(test_loader, device)), total=len(test_loader), desc='- [testing]', leave=False):
+        oom = False
+        try:
+            with torch.inference_mode(), torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=args.amp):
+                batch_result = evaluate_batch(model, batch_test, debug=args.debug, args=args)
+            for key in batch_result.keys():
+                batch_results[key].append(batch_result[key])
+        except torch.cuda.OutOfMemoryError:
+            oom = True
+        if oom:
+            torch.cuda.empty_cache() # outside the except block, so the failed forward's tensors can be released
+            continue
+        
+        if args.debug and i == 100:
+            break
     for key in batch_results.keys():
-        batch_results[key] = np.mean(batch_results[key])
+        batch_results[key] = mean_metric(batch_results[key])
     
     return batch_results
 
 
 def train_model(model, dataloaders, args, logger):
     train_loader, val_loader, test_loader = dataloaders
+    model = model.to(get_device(args.gpu)) # once, parameters and time encoder buffers
+    if args.compile:
+        # fuse the eager per-op dispatches of attention, soft_plus and the integral points; T lengths vary per batch
+        model.forward = torch.compile(model.forward, dynamic=True)
     optimizer = get_optimizer(model, args.optim, args.lr, args.l2)
     recorder = Recorder({'loss': 0}, args.checkpoint_dir, args.dataset, args.time_str, args=args)
     for i in range(args.epochs):
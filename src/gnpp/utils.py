@@ -258,7 +258,11 @@ def get_dataloader(train_set, val_set, test_set, args):
     pin_memory = False
     train_loader = DataLoader(train_set, batch_size=batch_size, shuffle=True, pin_memory=pin_memory)
     val_loader = None
-    test_loader = DataLoader(test_set, batch_size=batch_size, shuffle=True, pin_memory=pin_memory)
+    # test batches are prefetched to the device on a side stream (see evaluate_epoch):
+    # pinned host memory makes that copy asynchronous, workers are kept alive across epochs
+    num_workers = args.num_workers
+    test_loader = DataLoader(test_set, batch_size=batch_size, shuffle=True, pin_memory=args.gpu >= 0,
+                             num_workers=num_workers, persistent_workers=num_workers > 0)
     return train_loader, val_loader, test_loader
     
 
@@ -48,6 +48,46 @@ def get_optimizer(model, optim, lr, l2):
 def get_model_device(model):
     return next(model.parameters()).device
 
+def prefetch_to_device(loader, device):
+    """ iterate over `loader`, yielding batches already moved to `device`.
+    On cuda, the host->device copy of batch i+1 runs on a side stream while batch i is being consumed.
+    Batches should come from pinned memory (DataLoader(pin_memory=True)) for the copy to be asynchronous.
+    A batch whose copy runs out of cuda memory is skipped.
+    """
+    if device.type != 'cuda':
+        for batch in loader:
+            yield batch.to(device)
+        return
+
+    copy_stream = torch.cuda.Stream(device=device)
+    main_stream = torch.cuda.current_stream(device)
+
+    def wait_copied(batch, copied):
+        main_stream.wait_event(copied)
+        batch.record_stream(main_stream) # memory was allocated on copy_stream but is used on main_stream
+        return batch
+
+    pending = None
+    for batch in loader:
+        oom = False
+        try:
+            with torch.cuda.stream(copy_stream):
+                batch = batch.to(device, non_blocking=True)
+                copied = torch.cuda.Event()
+                copied.record(copy_stream)
+        except torch.cuda.OutOfMemoryError:
+            oom = True
+        if oom:
+            # skip the batch, like an OOM in the forward pass is skipped by the caller.
+            # empty the cache outside the except block, where the traceback no longer holds the failed copy
+            torch.cuda.empty_cache()
+            continue
+        if pending is not None:
+            yield wait_copied(*pending)
+        pending = (batch, copied)
+    if pending is not None:
+        yield wait_copied(*pending)
+
 
 
 class Recorder(object):